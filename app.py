@@ -1,67 +1,105 @@
 import streamlit as st
 import main
+import os
 import threading
+import itertools
+import logging
+import weakref
+from collections import deque
 from datetime import datetime
-import queue
-import time
+from logging.handlers import MemoryHandler, RotatingFileHandler
 import uuid
 
+MAX_LOG_LINES = 5000  # Oldest logs are dropped from the UI beyond this
+LOG_DIR = os.getenv("LOG_DIR", "logs")  # Full per-session logs are kept here
+LOG_FILE_MAX_BYTES = 5 * 1024 * 1024
+LOG_FILE_BACKUPS = 3
+
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+log = logging.getLogger(__name__)
+
+def close_session_log(log_file, *handlers):
+    """Flush and close log handlers in order, then delete the session's log files"""
+    for handler in handlers:
+        handler.close()
+    for path in [log_file] + [f"{log_file}.{i}" for i in range(1, LOG_FILE_BACKUPS + 1)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
 class ThreadSafeLogger:
     def __init__(self):
-        self.log_queue = queue.Queue()
-        self._lock = threading.Lock()
-        self.is_stopped = False
+        self.stop_event = threading.Event()  # Shared with main.main to abort in-flight work
         self.active_thread = None
-        self.log_history = []
-        self.processing_complete = threading.Event()
+        # Entries are (index, log) pairs. Writers hold a short lock so indices
+        # enter the deque in order; readers snapshot it without locking.
+        self._logs = deque(maxlen=MAX_LOG_LINES)
+        self._counter = itertools.count()
+        self._write_lock = threading.Lock()
+        self._write_idx = 0
         self.session_id = str(uuid.uuid4())[:8]  # Unique session ID for debugging
 
+        # The UI keeps only the tail; the full log goes to a rotating file,
+        # buffered so logging doesn't cost a write per line
+        os.makedirs(LOG_DIR, exist_ok=True)
+        self.log_file = os.path.join(LOG_DIR, f"session-{self.session_id}.log")
+        file_handler = RotatingFileHandler(
+            self.log_file, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS, encoding="utf-8", delay=True
+        )
+        self._file_buffer = MemoryHandler(capacity=100, target=file_handler)
+        # Not registered with logging.getLogger, so it is freed with the session
+        self._file_log = logging.Logger(f"session-{self.session_id}")
+        self._file_log.addHandler(self._file_buffer)
+        # Streamlit has no session-end hook; close and delete the file once the session's logger is collected
+        weakref.finalize(self, close_session_log, self.log_file, self._file_buffer, file_handler)
+
     def add_log(self, message):
-        """Add a log message to both queue and history"""
+        """Add a log message to history"""
         timestamp = datetime.now().strftime("%H:%M:%S")
         log_entry = f"[{timestamp}] {message}"
-        with self._lock:
-            self.log_history.append(log_entry)
-            self.log_queue.put(log_entry)
-        print(f"Added log: {log_entry}")  # Debug print
-
-    def get_new_logs(self):
-        """Get new logs from queue without removing them from history"""
-        new_logs = []
-        try:
-            while not self.log_queue.empty():
-                new_logs.append(self.log_queue.get_nowait())
-        except queue.Empty:
-            pass
-        return new_logs
-
-    def get_all_logs(self):
-        """Get complete log history"""
-        with self._lock:
-            return self.log_history.copy()
+        with self._write_lock:
+            index = next(self._counter)
+            self._logs.append((index, log_entry))
+            self._write_idx = index + 1
+        self._file_log.info(log_entry)
+        log.debug("Added log: %s", log_entry)
+
+    def get_new_logs(self, since=0):
+        """Get logs added after cursor `since` together with the new cursor"""
+        if since >= self._write_idx:
+            return [], since
+        # Snapshot first: iterating the deque while another thread appends raises
+        logs = list(self._logs)
+        if not logs:
+            return [], since
+        return [log for index, log in logs if index >= since], logs[-1][0] + 1
+
+    def get_full_log(self):
+        """Get the full log from disk, including rotated files"""
+        self._file_buffer.flush()
+        paths = [f"{self.log_file}.{i}" for i in range(LOG_FILE_BACKUPS, 0, -1)] + [self.log_file]
+        full_log = ""
+        for path in paths:
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    full_log += f.read()
+        return full_log
 
     def clear_logs(self):
         """Clear all logs"""
-        with self._lock:
-            self.log_history.clear()
-            # Clear queue
-            while not self.log_queue.empty():
-                try:
-                    self.log_queue.get_nowait()
-                except queue.Empty:
-                    break
+        self._logs.clear()
 
     def stop_processing(self):
         """Stop the processing thread"""
-        self.is_stopped = True
+        self.stop_event.set()
         if self.active_thread and self.active_thread.is_alive():
             self.add_log("🛑 Forcefully stopping process...")
-            self.processing_complete.set()
             self.active_thread = None
 
     def should_stop(self):
         """Check if processing should stop"""
-        return self.is_stopped
+        return self.stop_event.is_set()
 
     def set_current_thread(self, thread):
         """Set the current processing thread"""
@@ -76,77 +114,46 @@ def process_emails(logger):
     try:
         logger.add_log("🚀 Starting email processing...")
         if not logger.should_stop():
-            # Pass the logger.add_log function directly to main.main
-            main.main(logger.add_log)
+            # Pass the logger.add_log function and stop event directly to main.main
+            main.main(logger.add_log, logger.stop_event)
     except Exception as e:
         logger.add_log(f"❌ Error during processing: {str(e)}")
     finally:
         logger.add_log("✅ Email processing completed.")
-        st.session_state.is_processing = False
 
-def display_logs():
-    """Display logs in the UI"""
-    # Get all logs from history
-    logs = st.session_state.logger.get_all_logs()
-    
-    # Display logs
-    if logs:
-        # Create a container with fixed height and styling
-        st.markdown("""
-        <style>
-        .log-container {
-            height: 400px;
-            overflow-y: auto;
-            border: 1px solid #444;
-            padding: 10px;
-            font-family: monospace;
-            background-color: #1E1E1E;
-            color: #E0E0E0;
-            white-space: pre-wrap;
-            margin-bottom: 10px;
-        }
-        .log-line {
-            margin: 0;
-            padding: 2px 0;
-            border-bottom: 1px solid #333;
-        }
-        </style>
-        """, unsafe_allow_html=True)
-        
-        # Create log lines HTML
-        log_lines_html = ""
-        for log in logs:
-            log_lines_html += f'<div class="log-line">{log}</div>'
-        
-        # Display logs with auto-scroll
-        st.markdown(f"""
-        <div class="log-container" id="log-container">
-            {log_lines_html}
-        </div>
-        <script>
-            // Force scroll to bottom
-            document.addEventListener('DOMContentLoaded', function() {{
-                var container = document.getElementById('log-container');
-                if (container) container.scrollTop = container.scrollHeight;
-                
-                // Set up MutationObserver to keep scrolling to bottom when content changes
-                var observer = new MutationObserver(function() {{
-                    if (container) container.scrollTop = container.scrollHeight;
-                }});
-                
-                if (container) {{
-                    observer.observe(container, {{ childList: true, subtree: true }});
-                }}
-            }});
-        </script>
-        """, unsafe_allow_html=True)
-    else:
-        st.markdown("""
-        <div style="height: 400px; border: 1px solid #444; padding: 10px; 
-             font-family: monospace; background-color: #1E1E1E; color: #E0E0E0;">
-            No logs yet...
-        </div>
-        """, unsafe_allow_html=True)
+LOG_CSS = """
+<style>
+.log-line {
+    margin: 0;
+    padding: 2px 10px;
+    border-bottom: 1px solid #333;
+    font-family: monospace;
+    background-color: #1E1E1E;
+    color: #E0E0E0;
+    white-space: pre-wrap;
+}
+</style>
+"""
+
+def render_log_lines(logs):
+    """Render log entries as HTML lines"""
+    return "".join(f'<div class="log-line">{log}</div>' for log in logs)
+
+def display_logs(log_box):
+    """Append logs added since the last render to the log box"""
+    logger = st.session_state.logger
+
+    # Only the new tail is sent; elements written to log_box from the
+    # fragment accumulate across fragment reruns
+    new_logs, st.session_state.last_rendered = logger.get_new_logs(st.session_state.last_rendered)
+    if new_logs:
+        log_box.markdown(render_log_lines(new_logs), unsafe_allow_html=True)
+
+    # Processing finished or was stopped: do one full rerun so the buttons
+    # and status are rebuilt and this fragment stops auto-refreshing
+    if st.session_state.polling and not logger.is_thread_active():
+        st.session_state.is_processing = False
+        st.rerun()
 
 def main_ui():
     """Main UI function"""
@@ -156,11 +163,6 @@ def main_ui():
         st.session_state.logger = ThreadSafeLogger()
     if 'is_processing' not in st.session_state:
         st.session_state.is_processing = False
-    if 'refresh_counter' not in st.session_state:
-        st.session_state.refresh_counter = 0
-
-    # Increment refresh counter on each run
-    st.session_state.refresh_counter += 1
 
     st.title("📧 Email Analytics Dashboard")
     st.markdown("---")
@@ -173,7 +175,8 @@ def main_ui():
         if st.button("🚀 Run Email Processing", 
                      disabled=thread_active or st.session_state.is_processing,
                      use_container_width=True):
-            st.session_state.logger.is_stopped = False
+            # Fresh event per run; a stopped thread that is still unwinding keeps its own
+            st.session_state.logger.stop_event = threading.Event()
             st.session_state.is_processing = True
             processing_thread = threading.Thread(
                 target=process_emails, 
@@ -202,21 +205,32 @@ def main_ui():
 
     # Logs section
     st.markdown("### 📝 Process Logs")
-    
-    # Display logs
-    display_logs()
-    
-    # Get any new logs that might have been added
-    new_logs = st.session_state.logger.get_new_logs()
-    if new_logs:
-        # Force a rerun to display the new logs
-        time.sleep(0.1)
-        st.rerun()
-    
-    # Auto-refresh during processing
-    if thread_active or st.session_state.is_processing:
-        time.sleep(0.5)  # Refresh every 0.5 seconds
-        st.rerun()
+    st.markdown(LOG_CSS, unsafe_allow_html=True)
+
+    # Full runs rebuild the log box from history; fragment ticks only append to it
+    log_box = st.container(height=400)
+    logs, st.session_state.last_rendered = st.session_state.logger.get_new_logs()
+    if logs:
+        log_box.markdown(render_log_lines(logs), unsafe_allow_html=True)
+    elif not st.session_state.is_processing:
+        log_box.markdown("No logs yet...")
+
+    # Only the log fragment re-runs while processing, not the whole page
+    run_every = 0.5 if (thread_active or st.session_state.is_processing) else None
+    st.session_state.polling = run_every is not None
+    st.fragment(run_every=run_every)(display_logs)(log_box)
+
+    # The full log can be megabytes, so it is only read from disk when asked for
+    if not st.session_state.is_processing and st.button("📄 Prepare Full Log"):
+        full_log = st.session_state.logger.get_full_log()
+        if full_log:
+            st.download_button(
+                "⬇️ Download Full Log",
+                data=full_log,
+                file_name=f"email-processing-{st.session_state.logger.session_id}.log",
+            )
+        else:
+            st.info("No logs yet...")
 
 if __name__ == "__main__":
     st.set_page_config(page_title="Email Analytics Dashboard", page_icon="📧", layout="wide")
@@ -1,17 +1,26 @@
 import asyncio
+import functools
 import json
+import logging
 import os
 from typing import List, Dict, Tuple
+import queue
 import time
-from datetime import datetime
+from collections import Counter
+from datetime import datetime, timedelta, timezone
 import threading
+import aiohttp
+import orjson
+import pandas as pd
 import requests
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 import urllib.parse
 from dotenv import load_dotenv
 from traceback import format_exc
 import streamlit as st
 
+log = logging.getLogger(__name__)
 
 # 🔹 Microsoft Entra (Azure AD) Credentials (SECURE THESE!)
 TENANT_ID = os.getenv("TENANT_ID") or st.secrets.get("TENANT_ID")
@@ -19,9 +28,17 @@ CLIENT_ID = os.getenv("CLIENT_ID") or st.secrets.get("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET") or st.secrets.get("CLIENT_SECRET")
 MAILBOX_ADDRESS = os.getenv("MAILBOX_ADDRESS") or st.secrets.get("MAILBOX_ADDRESS")
 BATCH_SIZE = 50  # Fetch emails in batches of 10
-MAX_WORKERS = 5  # Number of concurrent threads
+# Max concurrent Graph requests; Outlook allows 4 concurrent requests per app per mailbox,
+# so going higher only earns 429 throttling
+MAX_WORKERS = int(os.getenv("MAX_WORKERS") or 4)
 MAX_RETRIES = 3  # Max retry attempts
 RETRY_DELAY = 10  # Delay between retries (in seconds)
+REQUEST_TIMEOUT = (5, 30)  # (connect, read) timeout for every HTTP call (in seconds)
+SYNC_STATE_FILE = os.getenv("SYNC_STATE_FILE", "sync_state.json")  # Delta link saved between runs
+WINDOW_DAYS = int(os.getenv("WINDOW_DAYS") or 0)  # Only scan mail from the last N days (0 = all mail)
+AIRTABLE_BATCH_SIZE = 10  # Max records per Airtable write request
+AIRTABLE_MAX_WORKERS = 5  # Concurrent Airtable write requests
+AIRTABLE_REQUEST_INTERVAL = 0.2  # Seconds between Airtable requests (5 req/sec limit)
 
 # Airtable Config
 AIRTABLE_API_KEY = os.getenv("AIRTABLE_API_KEY") or st.secrets.get("AIRTABLE_API_KEY")
@@ -29,23 +46,42 @@ AIRTABLE_BASE_ID = os.getenv("AIRTABLE_BASE_ID") or st.secrets.get("AIRTABLE_BAS
 AIRTABLE_TABLE_NAME = os.getenv("AIRTABLE_TABLE_NAME") or st.secrets.get("AIRTABLE_TABLE_NAME")
 
 GRAPH_API_URL = "https://graph.microsoft.com/v1.0"
+SENT_ITEMS_URL = f"{GRAPH_API_URL}/users/{MAILBOX_ADDRESS}/mailFolders/SentItems"
+SENT_MESSAGES_URL = f"{SENT_ITEMS_URL}/messages"
+MESSAGE_FIELDS = "subject,sender,toRecipients,ccRecipients,bccRecipients,receivedDateTime"  # $select for messages
+TOKEN_URL = f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/token"
+AIRTABLE_URL = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}"
+
+# Shared HTTP session so every request reuses pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+GRAPH_TIMEOUT = aiohttp.ClientTimeout(sock_connect=REQUEST_TIMEOUT[0], sock_read=REQUEST_TIMEOUT[1])
 
 HEADERS_AIRTABLE = {
     "Authorization": f"Bearer {AIRTABLE_API_KEY}",
     "Content-Type": "application/json"
 }
 
-# Function to format dates for Airtable
-def format_date_for_airtable(date_string):
+GRAPH_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# Parse Graph timestamps (cached: strptime is slow and timestamps repeat)
+@functools.lru_cache(maxsize=200_000)
+def parse_graph_datetime(date_string):
     try:
-        dt = datetime.strptime(date_string, "%Y-%m-%dT%H:%M:%SZ")
-        return dt.strftime("%Y/%m/%d")
-    except ValueError:
+        return datetime.strptime(date_string, GRAPH_DATETIME_FORMAT)
+    except (TypeError, ValueError):
         return None
 
-# OAuth2 Token Retrieval
-def get_access_token():
-    url = f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/token"
+# Access token reused across runs until shortly before it expires
+_token_cache = {"token": None, "expires_at": 0}
+TOKEN_EXPIRY_MARGIN = 60  # Refresh this many seconds before expiry
+
+# OAuth2 Token Retrieval; pass a token Graph rejected as `expired` to force a new one
+def get_access_token(expired=None):
+    cached = _token_cache["token"]
+    if cached and cached != expired and time.time() < _token_cache["expires_at"] - TOKEN_EXPIRY_MARGIN:
+        return cached
+
     payload = {
         "client_id": CLIENT_ID,
         "client_secret": CLIENT_SECRET,
@@ -53,105 +89,409 @@ def get_access_token():
         "scope": "https://graph.microsoft.com/.default",
     }
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    response = requests.post(url, data=payload, headers=headers)
-    return response.json().get("access_token")
-
-# Get total email count in Sent folder
-def get_total_email_count(access_token):
-    url = f"{GRAPH_API_URL}/users/{MAILBOX_ADDRESS}/mailFolders/SentItems"
-    headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.get(url, headers=headers)
+    response = SESSION.post(TOKEN_URL, data=payload, headers=headers, timeout=REQUEST_TIMEOUT)
     data = response.json()
-    return data.get("totalItemCount", 0)
+    if data.get("access_token"):
+        _token_cache.update(token=data["access_token"], expires_at=time.time() + data.get("expires_in", 3600))
+    return data.get("access_token")
+
+# Start of the WINDOW_DAYS scan window as a Graph timestamp, or None to scan everything
+def window_start():
+    if not WINDOW_DAYS:
+        return None
+    return (datetime.now(timezone.utc) - timedelta(days=WINDOW_DAYS)).strftime(GRAPH_DATETIME_FORMAT)
 
 def log_message(message, callback_fn=None):
-    """Send log message to logger"""
+    """Send log message to the UI callback, or the console when run standalone"""
     if callback_fn:
         callback_fn(message)  # Use the callback function
-    print(message)  # Keep console logging
+    else:
+        log.info(message)
     
-def extract_emails(data):
-    result = {}
-    for recipient in data.get("toRecipients", []) + data.get("ccRecipients", []) + data.get("bccRecipients", []):
-        email = recipient["emailAddress"]["address"]
-        name = recipient["emailAddress"]["name"]
-        result[email] = name
-    return result
-
-# Fetch emails from Outlook
-def fetch_sent_emails(batch_number, email_data, lock, access_token, callback_fn=None):
-    skip = batch_number * BATCH_SIZE
-    url = f"{GRAPH_API_URL}/users/{MAILBOX_ADDRESS}/mailFolders/SentItems/messages?$top={BATCH_SIZE}&$skip={skip}&$select=subject,sender,toRecipients,ccRecipients,bccRecipients,receivedDateTime"
-    
-    headers = {"Authorization": f"Bearer {access_token}"}
+def load_sync_state():
+    """Load the delta link and newest synced timestamp saved by the last run"""
+    try:
+        with open(SYNC_STATE_FILE) as f:
+            state = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    # A delta link for another mailbox would add that mailbox's mail
+    return state if state.get("mailbox") == MAILBOX_ADDRESS else {}
+
+def save_sync_state(state):
+    """Persist sync state atomically so a crash never leaves a half-written file"""
+    tmp_path = f"{SYNC_STATE_FILE}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, SYNC_STATE_FILE)
+
+def clear_sync_state():
+    """Forget the delta link so the next run does a full sync"""
+    try:
+        os.remove(SYNC_STATE_FILE)
+    except FileNotFoundError:
+        pass
+
+def newest_received(email_data, default=None):
+    """Latest receivedDateTime among the emails, as a Graph timestamp string"""
+    dates = [dt for dt in (parse_graph_datetime(email["received"]) for email in email_data) if dt]
+    return max(dates).strftime(GRAPH_DATETIME_FORMAT) if dates else default
+
+RECIPIENT_FIELDS = (("toRecipients", "to"), ("ccRecipients", "cc"), ("bccRecipients", "bcc"))
+
+def parse_message(msg):
+    """Flatten a Graph message in one pass over its recipients"""
+    email_info = {
+        "subject": msg.get("subject", "No Subject"),
+        "from": msg.get("sender", {}).get("emailAddress", {}).get("address", "Unknown"),
+        "received": msg.get("receivedDateTime", "Unknown"),
+    }
+    name_data = {}
+    for field, key in RECIPIENT_FIELDS:
+        addresses = email_info[key] = []
+        for recipient in msg.get(field, ()):
+            # Normalized so one recipient written in different cases aggregates to one row
+            address = recipient["emailAddress"]["address"].strip().lower()
+            addresses.append(address)
+            name_data[address] = recipient["emailAddress"]["name"]
+    email_info["name_data"] = name_data
+    return email_info
+
+# Seconds to wait before retrying a throttled Graph response
+def retry_after(response):
+    try:
+        return float(response.headers.get("Retry-After", RETRY_DELAY))
+    except ValueError:
+        return RETRY_DELAY
+
+# Swap a fresh token into a Graph session after `response` was rejected with
+# 401 (the token expired mid-run); returns True if there is a new token to retry with
+def refresh_session_token(session, response):
+    rejected = response.request_info.headers.get("Authorization", "").removeprefix("Bearer ")
+    # Blocks the loop briefly; requests rejected with the same old token reuse the new one
+    token = get_access_token(expired=rejected)
+    if not token or token == rejected:
+        return False
+    session.headers["Authorization"] = f"Bearer {token}"
+    return True
+
+# GET a Graph page with retries; returns the parsed JSON or None
+async def get_graph_page(session, url, description, callback_fn=None, params=None):
     retries = 0
-    
+
     while retries < MAX_RETRIES:
-        response = requests.get(url, headers=headers)
-
-        if response.status_code == 200:
-            messages = response.json().get("value", [])
-            batch_emails = []
-            for msg in messages:
-                
-                email_info = {
-                    "subject": msg.get("subject", "No Subject"),
-                    "from": msg.get("sender", {}).get("emailAddress", {}).get("address", "Unknown"),
-                    "to": [recipient["emailAddress"]["address"] for recipient in msg.get("toRecipients", [])],
-                    "cc": [recipient["emailAddress"]["address"] for recipient in msg.get("ccRecipients", [])],
-                    "bcc": [recipient["emailAddress"]["address"] for recipient in msg.get("bccRecipients", [])],
-                    "received": msg.get("receivedDateTime", "Unknown"),
-                    "name_data": extract_emails(msg)
-                }
-                batch_emails.append(email_info)
-
-            with lock:
-                email_data.extend(batch_emails)
-                log_message(f"[Thread-{threading.current_thread().name}] ✅ Batch {batch_number} fetched. Total emails so far: {len(email_data)}", callback_fn)
+        try:
+            async with session.get(url, params=params) as response:
+                if response.status == 200:
+                    return orjson.loads(await response.read())
+
+                if response.status in (429, 503):
+                    # Throttled: wait as long as Graph asks, without using up a retry
+                    log_message(f"⏳ Throttled fetching {description}, retrying after {retry_after(response)}s", callback_fn)
+                    await asyncio.sleep(retry_after(response))
+                    continue
+
+                error = await response.text()
+                refreshed = response.status == 401 and refresh_session_token(session, response)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error, refreshed = str(e) or type(e).__name__, False
+        log_message(f"❌ Error fetching {description} (Attempt {retries+1}/{MAX_RETRIES}): {error}", callback_fn)
+        retries += 1
+        if not refreshed:
+            await asyncio.sleep(RETRY_DELAY)
+
+    log_message(f"❌ {description.capitalize()} failed after {MAX_RETRIES} retries.", callback_fn)
+    return None
+
+# Receive time of the oldest or newest email in Sent Items, optionally only since `since`
+async def get_received_bound(session, order, callback_fn=None, since=None):
+    params = {"$top": 1, "$orderby": f"receivedDateTime {order}", "$select": "receivedDateTime"}
+    if since:
+        params["$filter"] = f"receivedDateTime ge {since}"
+    data = await get_graph_page(session, SENT_MESSAGES_URL, f"{order} bound", callback_fn, params)
+    if data is None:
+        raise RuntimeError(f"Could not look up the {order} receive time")
+    messages = data.get("value", [])
+    return parse_graph_datetime(messages[0]["receivedDateTime"]) if messages else None
+
+# Get total email count in Sent folder, or only of mail received since `since`
+async def get_total_email_count(session, callback_fn=None, since=None):
+    if since:
+        # $count answers with a bare number, which parses as JSON
+        params = {"$filter": f"receivedDateTime ge {since}"}
+        count = await get_graph_page(session, f"{SENT_MESSAGES_URL}/$count", "email count", callback_fn, params)
+        return count or 0
+    data = await get_graph_page(session, SENT_ITEMS_URL, "Sent folder", callback_fn)
+    return (data or {}).get("totalItemCount", 0)
+
+def split_time_range(oldest, newest, parts):
+    """Split [oldest, newest] into `parts` (start, end) ranges; the outer ends stay open (None)"""
+    step = (newest - oldest) / parts
+    bounds = sorted({(oldest + step * i).strftime(GRAPH_DATETIME_FORMAT) for i in range(1, parts)})
+    return list(zip([None] + bounds, bounds + [None]))
+
+# Fetch emails from Outlook
+async def fetch_sent_emails(session, start, end, on_page, callback_fn=None, should_stop=lambda: False):
+    """Fetch Sent Items received in [start, end), newest first; returns False
+    if a page could not be fetched.
+
+    Pages by a receivedDateTime cursor instead of $skip, so deep pages cost the
+    server no more than the first one. Each page's filter depends on the last
+    message of the page before, so a range has one request in flight; the next
+    one is sent before the current page is parsed.
+    """
+    def request_page(op=None, cursor=None, skip=0):
+        filters = [f"receivedDateTime ge {start}"] if start else []
+        if op:
+            filters.append(f"receivedDateTime {op} {cursor}")
+        elif end:
+            filters.append(f"receivedDateTime lt {end}")
+        params = {
+            "$top": BATCH_SIZE,
+            "$orderby": "receivedDateTime desc",
+            "$select": MESSAGE_FIELDS,
+        }
+        if filters:
+            params["$filter"] = " and ".join(filters)
+        if skip:
+            params["$skip"] = skip
+        description = f"page before {cursor or end or 'now'}"
+        return asyncio.create_task(get_graph_page(session, SENT_MESSAGES_URL, description, callback_fn, params))
+
+    cursor, seen_at_cursor = None, set()
+    tie_skip = None  # Set while walking a single second that holds more than a page of mail
+    pending = request_page()
+    while pending:
+        data = await pending
+        pending = None
+        if data is None:
+            return False
+
+        messages = data.get("value", [])
+        new_messages = [msg for msg in messages if msg["id"] not in seen_at_cursor]
+        stopping = should_stop()
+        if tie_skip is not None and not stopping:
+            seen_at_cursor.update(msg["id"] for msg in messages)
+            if len(messages) == BATCH_SIZE:
+                tie_skip += BATCH_SIZE
+                pending = request_page("eq", cursor, tie_skip)
+            else:
+                tie_skip = None
+                pending = request_page("lt", cursor)
+        elif len(messages) == BATCH_SIZE and not stopping:
+            last = messages[-1]["receivedDateTime"]
+            if new_messages:
+                # Ask for the cursor second again (le) so messages sharing it aren't skipped
+                at_last = {msg["id"] for msg in messages if msg["receivedDateTime"] == last}
+                seen_at_cursor = at_last | seen_at_cursor if last == cursor else at_last
+                cursor = last
+                pending = request_page("le", cursor)
+            else:
+                # A full page shares one second: walk it with a small $skip
+                tie_skip = 0
+                pending = request_page("eq", cursor)
+
+        on_page([parse_message(msg) for msg in new_messages])
+
+    return True
+
+# Fetch all emails, one cursor-paginated receive-time range per worker
+async def fetch_all_sent_emails(graph_headers, on_emails, callback_fn=None, should_stop=lambda: False, since=None):
+    """Hand each fetched page to on_emails as it arrives; returns the number of
+    emails and whether every range was fetched completely.
+    With `since`, only mail received at or after it is fetched."""
+    fetched = 0
+    batch = 0
+
+    def on_page(page_emails):
+        nonlocal fetched, batch
+        # Everything runs on the event loop thread, so no lock is needed
+        on_emails(page_emails)
+        fetched += len(page_emails)
+        batch += 1
+        log_message(f"✅ Batch {batch} fetched. Total emails so far: {fetched}", callback_fn)
+
+    async def fetch_range(session, start, end):
+        try:
+            return await fetch_sent_emails(session, start, end, on_page, callback_fn, should_stop)
+        except Exception as e:
+            log_message(f"❌ Error fetching emails from {start or 'the start'} to {end or 'now'}: {str(e)}", callback_fn)
+            return False
+
+    connector = aiohttp.TCPConnector(limit=MAX_WORKERS)
+    async with aiohttp.ClientSession(headers=graph_headers, connector=connector, timeout=GRAPH_TIMEOUT) as session:
+        try:
+            oldest, newest = await asyncio.gather(
+                get_received_bound(session, "asc", callback_fn, since),
+                get_received_bound(session, "desc", callback_fn, since),
+            )
+        except Exception as e:
+            log_message(f"❌ Error finding the Sent folder's time range: {str(e)}", callback_fn)
+            return fetched, False
+        if not oldest or not newest:
+            return fetched, True
+
+        # Each range keeps one request in flight; the oldest one is closed at the window start
+        ranges = split_time_range(oldest, newest, MAX_WORKERS)
+        ranges[0] = (since, ranges[0][1])
+        completed = await asyncio.gather(*(fetch_range(session, start, end) for start, end in ranges))
+
+    return fetched, all(completed)
+
+# Run a fetch coroutine, cancelling it (and any in-flight request or retry wait) on stop
+async def run_until_stopped(coro, stop_event):
+    task = asyncio.ensure_future(coro)
+    while not task.done():
+        if stop_event.is_set():
+            task.cancel()
+            break
+        await asyncio.wait({task}, timeout=0.2)
+    try:
+        return await task
+    except asyncio.CancelledError:
+        return None
+
+# Follow a delta query to its end; returns (emails, next delta link)
+async def fetch_delta_emails(url, graph_headers, callback_fn=None, should_stop=lambda: False, params=None):
+    emails = []
+    page = 0
+
+    async with aiohttp.ClientSession(headers=graph_headers, timeout=GRAPH_TIMEOUT) as session:
+        while url:
+            if should_stop():
+                break
+            data = await get_graph_page(session, url, f"delta page {page}", callback_fn, params)
+            if data is None:
+                break
+            # Deleted messages come back as "@removed" stubs
+            emails.extend(parse_message(msg) for msg in data.get("value", []) if "@removed" not in msg)
+            if "@odata.deltaLink" in data:
+                return emails, data["@odata.deltaLink"]
+            # nextLink already carries the original query
+            url, params = data.get("@odata.nextLink"), None
+            page += 1
+
+    return emails, None
+
+# First sync: start change tracking, then scan the whole Sent folder
+async def full_sync(graph_headers, on_emails, sync_started, callback_fn=None, should_stop=lambda: False, since=None):
+    """Scan the Sent folder into on_emails; returns the delta link for the next run
+    and whether the scan was complete.
+    The total count is only logged, so it is fetched alongside the scan instead of before it."""
+    async def log_total():
+        try:
+            # A coroutine rather than a worker thread, so stopping the run cancels it
+            async with aiohttp.ClientSession(headers=graph_headers, timeout=GRAPH_TIMEOUT) as session:
+                total_emails = await get_total_email_count(session, callback_fn, since)
+        except Exception as e:
+            log_message(f"⚠️ Could not count emails in Sent folder: {str(e)}", callback_fn)
             return
-        
+        if since:
+            log_message(f"📩 Emails in Sent folder from the last {WINDOW_DAYS} days: {total_emails}", callback_fn)
         else:
-            log_message(f"[Thread-{threading.current_thread().name}] ❌ Error fetching batch {batch_number} (Attempt {retries+1}/{MAX_RETRIES}): {response.text}", callback_fn)
-            retries += 1
-            time.sleep(RETRY_DELAY)
-    
-    log_message(f"[Thread-{threading.current_thread().name}] ❌ Batch {batch_number} failed after {MAX_RETRIES} retries.", callback_fn)
-
-# Aggregate email data
-def aggregate_email_data(email_data):
-    email_stats = {}
+            log_message(f"📩 Total emails in Sent folder: {total_emails}", callback_fn)
 
+    count_task = asyncio.create_task(log_total())
+    try:
+        # The delta link is taken before the scan so mail sent meanwhile is picked up next run
+        _, delta_link = await fetch_delta_emails(
+            f"{SENT_MESSAGES_URL}/delta", graph_headers, callback_fn, should_stop,
+            params={
+                "$select": MESSAGE_FIELDS,
+                "$filter": f"receivedDateTime ge {sync_started}",
+            },
+        )
+        _, complete = await fetch_all_sent_emails(graph_headers, on_emails, callback_fn, should_stop, since)
+        await count_task
+    finally:
+        count_task.cancel()
+    return delta_link, complete
+
+# Per-recipient stat rows for a batch of emails
+def email_stat_rows(email_data):
+    # One row per unique recipient of each email; the recipient union, the
+    # date and the per-email count are built once per email
+    rows = []
     for email in email_data:
         recipients = email["to"] + email["cc"] + email["bcc"]
-        for recipient in set(recipients):
-            domain = recipient.split("@")[-1] if "@" in recipient else "unknown"
-
-            if recipient not in email_stats:
-                email_stats[recipient] = {
-                    "Recipient Email": recipient,
-                    "Company / Management": domain,
-                    "Total Mails Sent": 0,
-                    "Name": email.get("name_data", {}).get(recipient, ""),
-                    "Last Interacted Date": format_date_for_airtable(email["received"]),
-                }
-
-            email_stats[recipient]["Total Mails Sent"] += recipients.count(recipient)
-            email_stats[recipient]["Last Interacted Date"] = max(
-                email_stats[recipient]["Last Interacted Date"], format_date_for_airtable(email["received"])
-            )
-
-    return list(email_stats.values())
+        date = parse_graph_datetime(email["received"])
+        name_data = email.get("name_data", {})
+        for recipient, count in Counter(recipients).items():
+            rows.append((recipient, count, date, name_data.get(recipient, "")))
+    return rows
+
+# Aggregate stat rows into one Airtable entry per recipient
+def aggregate_stat_rows(rows):
+    if not rows:
+        return []
+
+    df = pd.DataFrame(rows, columns=["recipient", "count", "date", "name"])
+    # Compare real datetimes and only format for Airtable at the end
+    df["date"] = pd.to_datetime(df["date"])
+    stats = df.groupby("recipient", sort=False).agg(
+        total=("count", "sum"), last=("date", "max"), name=("name", "first")
+    ).reset_index()
+
+    has_domain = stats["recipient"].str.contains("@", regex=False)
+    aggregated = pd.DataFrame({
+        "Recipient Email": stats["recipient"],
+        "Company / Management": stats["recipient"].str.rsplit("@", n=1).str[-1].where(has_domain, "unknown"),
+        "Total Mails Sent": stats["total"],
+        "Name": stats["name"],
+        "Last Interacted Date": stats["last"].dt.strftime("%Y/%m/%d").astype(object).where(stats["last"].notna(), None),
+    })
+    return aggregated.to_dict("records")
+
+class EmailStatsAggregator:
+    """Turns pages of emails into stat rows on a background thread, so
+    aggregation overlaps with fetching instead of waiting for it"""
+
+    def __init__(self):
+        self._pages = queue.Queue()
+        self._error = None
+        self.rows = []
+        self.newest = None  # Latest receivedDateTime seen
+        self._thread = threading.Thread(target=self._consume, daemon=True)
+        self._thread.start()
+
+    def add_emails(self, emails):
+        """Queue a page of emails; pages are queued whole to keep queue traffic low"""
+        if emails:
+            self._pages.put(emails)
+
+    def _consume(self):
+        while (emails := self._pages.get()) is not None:
+            try:
+                self.rows.extend(email_stat_rows(emails))
+                page_newest = newest_received(emails)
+                if page_newest and (not self.newest or page_newest > self.newest):
+                    self.newest = page_newest
+            except Exception as e:
+                self._error = e
+
+    def close(self):
+        """Wait for queued pages to be consumed; safe to call more than once"""
+        if self._thread.is_alive():
+            self._pages.put(None)
+            self._thread.join()
+        error, self._error = self._error, None
+        if error:
+            raise error
+
+    def aggregate(self):
+        """Close the queue and aggregate everything seen"""
+        self.close()
+        return aggregate_stat_rows(self.rows)
 
 # Fetch all existing Airtable records
 def fetch_all_airtable_records():
-    url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}"
     all_records = []
     params = {"pageSize": 100}  # Max records per request
 
     while True:
-        response = requests.get(url, headers=HEADERS_AIRTABLE, params=params)
+        response = SESSION.get(AIRTABLE_URL, headers=HEADERS_AIRTABLE, params=params, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
         
         all_records.extend(data.get("records", []))
         
@@ -162,12 +502,42 @@ def fetch_all_airtable_records():
 
     return all_records
 
+# Send Airtable writes in parallel batches
+def send_airtable_batches(method, url, records):
+    """Send records in batches of AIRTABLE_BATCH_SIZE, returning (batch, response) pairs.
+    Every batch is sent before the first request error, if any, is raised."""
+    batches = [
+        {"records": records[i : i + AIRTABLE_BATCH_SIZE]}
+        for i in range(0, len(records), AIRTABLE_BATCH_SIZE)
+    ]
+
+    def send(batch):
+        return SESSION.request(method, url, headers=HEADERS_AIRTABLE, data=orjson.dumps(batch), timeout=REQUEST_TIMEOUT)
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=AIRTABLE_MAX_WORKERS) as executor:
+        for batch in batches:
+            futures.append(executor.submit(send, batch))
+            time.sleep(AIRTABLE_REQUEST_INTERVAL)  # Stay under Airtable's rate limit
+
+    errors = [future.exception() for future in futures if future.exception()]
+    if errors:
+        raise errors[0]
+    return [(batch, future.result()) for batch, future in zip(batches, futures)]
+
 # Push aggregated data to Airtable
-def push_to_airtable(aggregated_data, callback_fn=None):
-    existing_records = fetch_all_airtable_records()
+def push_to_airtable(aggregated_data, callback_fn=None, incremental=False, existing_records=None):
+    """Sync stats to Airtable; with incremental=True the stats cover only new
+    emails and are added on top of the existing records. Returns False if any
+    batch was rejected."""
+    if existing_records is None:
+        existing_records = fetch_all_airtable_records()
+    # Keys are normalized like the lookups below, so case or whitespace
+    # differences don't turn existing recipients into duplicate inserts
     existing_records_dict = {
-        record["fields"]["Recipient Email"]: {"id": record["id"], "fields": record["fields"]}
+        record["fields"]["Recipient Email"].strip().lower(): {"id": record["id"], "fields": record["fields"]}
         for record in existing_records
+        if record["fields"].get("Recipient Email")
     }
     
     log_message(f"Found {len(existing_records)} existing records")
@@ -188,10 +558,16 @@ def push_to_airtable(aggregated_data, callback_fn=None):
             existing_fields = record["fields"]
             record_id = record["id"]
 
+            if incremental:
+                total_mails_sent += existing_fields.get("Total Mails Sent", 0)
+                existing_last = existing_fields.get("Last Interacted Date")  # Airtable returns YYYY-MM-DD
+                if existing_last and (not last_interacted or existing_last > last_interacted.replace("/", "-")):
+                    last_interacted = existing_last.replace("-", "/")
+
             # Check if values are different before updating
             needs_update = (
                 existing_fields.get("Total Mails Sent") != total_mails_sent or
-                existing_fields.get("Last Interacted Date") != last_interacted.replace("/", "-")
+                existing_fields.get("Last Interacted Date") != (last_interacted and last_interacted.replace("/", "-"))
             )
 
             if needs_update:
@@ -207,89 +583,134 @@ def push_to_airtable(aggregated_data, callback_fn=None):
             no_of_new_records += 1
             new_records.append({"fields": entry})
             
-    url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}"
+    all_ok = True
 
     # Insert new records
-    for i in range(0, len(new_records), 10):
-        batch = {"records": new_records[i : i + 10]}
-        response = requests.post(url, headers=HEADERS_AIRTABLE, json=batch)
-        log_message(f"✅ Uploaded {len(batch['records'])} new records to Airtable", callback_fn)
+    for batch, response in send_airtable_batches("POST", AIRTABLE_URL, new_records):
+        if response.ok:
+            log_message(f"✅ Uploaded {len(batch['records'])} new records to Airtable", callback_fn)
+        else:
+            all_ok = False
+            log_message(f"❌ Failed to upload {len(batch['records'])} new records: {response.text}", callback_fn)
 
     # Update existing records
-    for i in range(0, len(update_records), 10):
-        batch = {"records": update_records[i : i + 10]}
-        response = requests.patch(url, headers=HEADERS_AIRTABLE, json=batch)
-        log_message(f"🔄 Updated {len(batch['records'])} records in Airtable", callback_fn)
+    for batch, response in send_airtable_batches("PATCH", AIRTABLE_URL, update_records):
+        if response.ok:
+            log_message(f"🔄 Updated {len(batch['records'])} records in Airtable", callback_fn)
+        else:
+            all_ok = False
+            log_message(f"❌ Failed to update {len(batch['records'])} records: {response.text}", callback_fn)
     
     log_message(f"Total no of new records: {no_of_new_records}", callback_fn)
     log_message(f"Total no of updated records: {no_of_updated_records}", callback_fn)    
+    return all_ok
+
+# Incremental runs add to the Airtable totals, so two overlapping runs would
+# count the same mail twice; only one run per process may sync at a time
+_run_lock = threading.Lock()
 
 # Main function
-def main(callback_fn=None):
-    """Main function that processes emails"""
-    def should_stop():
-        return hasattr(callback_fn, '__self__') and callback_fn.__self__.should_stop()
+def main(callback_fn=None, stop_event=None):
+    """Main function that processes emails; set stop_event to abort"""
+    if not _run_lock.acquire(blocking=False):
+        log_message("⚠️ Another run is still in progress; try again once it finishes", callback_fn)
+        return
+    try:
+        sync_emails(callback_fn, stop_event)
+    finally:
+        _run_lock.release()
+
+def sync_emails(callback_fn=None, stop_event=None):
+    """Fetch, aggregate and push one sync; callers hold _run_lock"""
+    stop_event = stop_event or threading.Event()
+    should_stop = stop_event.is_set
 
     # Check for stop before starting
     if should_stop():
         log_message("🛑 Processing stopped by user", callback_fn)
         return
 
+    # Read Airtable in the background while the token and Graph are fetched; all are network-bound
+    airtable_reader = ThreadPoolExecutor(max_workers=1)
+    existing_records = airtable_reader.submit(fetch_all_airtable_records)
+    airtable_reader.shutdown(wait=False)
+
     access_token = get_access_token()
     if not access_token:
         log_message("❌ Failed to get access token", callback_fn)
         return
+    graph_headers = {"Authorization": f"Bearer {access_token}"}
 
     if should_stop():
         log_message("🛑 Processing stopped by user", callback_fn)
         return
-    
-    total_emails = get_total_email_count(access_token)
-    log_message(f"📩 Total emails in Sent folder: {total_emails}", callback_fn)
-
-    total_batches = (total_emails // BATCH_SIZE) + (1 if total_emails % BATCH_SIZE != 0 else 0)
-    email_data = []
-    lock = threading.Lock()
-
-    def process_batch(batch):
-        if should_stop():
-            return None
-        try:
-            # Pass callback_fn to fetch_sent_emails
-            return fetch_sent_emails(batch, email_data, lock, access_token, callback_fn)
-        except Exception as e:
-            log_message(f"❌ Error in batch {batch}: {str(e)}", callback_fn)
-            return None
 
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = []
-        for batch in range(total_batches):
-            if should_stop():
-                log_message("🛑 Processing stopped by user", callback_fn)
-                # Cancel any pending futures
-                for future in futures:
-                    future.cancel()
-                return
-            futures.append(executor.submit(process_batch, batch))
-        
-        for future in as_completed(futures):
-            if should_stop():
-                # Cancel remaining futures
-                for f in futures:
-                    f.cancel()
-                break
+    aggregator = EmailStatsAggregator()
+    # The aggregator thread only exits on close(), so close it even if fetching raises
+    try:
+        state = load_sync_state()
+        delta_link = None
+        complete = True  # Cleared when any page or range could not be fetched
+        incremental = bool(state.get("delta_link"))
+
+        if incremental:
+            # Only changes since the last run: no need to walk the whole Sent folder
+            log_message("🔁 Fetching Sent folder changes since the last run...", callback_fn)
+            changed_emails, delta_link = asyncio.run(run_until_stopped(
+                fetch_delta_emails(state["delta_link"], graph_headers, callback_fn, should_stop), stop_event
+            )) or ([], None)
+            # Delta also returns edited older messages; only count mail newer than the last sync
+            synced_until = parse_graph_datetime(state.get("last_received"))
+            email_data = [
+                email for email in changed_emails
+                if not synced_until or (parse_graph_datetime(email["received"]) or datetime.min) > synced_until
+            ]
+            log_message(f"📩 New emails since last run: {len(email_data)}", callback_fn)
+
+            if delta_link is None and not should_stop():
+                log_message("⚠️ Delta sync failed, falling back to a full sync", callback_fn)
+                incremental = False
+            else:
+                aggregator.add_emails(email_data)
+
+        if not incremental:
+            # Start change tracking before the scan so mail sent meanwhile is picked up next run
+            sync_started = datetime.now(timezone.utc).strftime(GRAPH_DATETIME_FORMAT)
+            # Pages are aggregated on the aggregator thread as they arrive
+            delta_link, complete = asyncio.run(run_until_stopped(full_sync(
+                graph_headers, aggregator.add_emails, sync_started, callback_fn, should_stop, window_start()
+            ), stop_event)) or (None, False)
+
+        if not should_stop():
+            # Only process results if not stopped
             try:
-                future.result()
+                aggregated_data = aggregator.aggregate()
+                if not complete:
+                    # A full sync writes absolute totals, so a partial scan would
+                    # overwrite correct Airtable counts with lower ones
+                    clear_sync_state()
+                    log_message("⚠️ Sent folder scan was incomplete; Airtable was not updated and the next run will do a full sync", callback_fn)
+                    return
+                pushed = push_to_airtable(aggregated_data, callback_fn, incremental=incremental, existing_records=existing_records.result())
+                # Saved only after a successful push; otherwise the state is dropped
+                # so the next run redoes a full sync instead of adding on top of
+                # partially written totals
+                if delta_link and pushed:
+                    previous = state.get("last_received") if incremental else sync_started
+                    save_sync_state({
+                        "mailbox": MAILBOX_ADDRESS,
+                        "delta_link": delta_link,
+                        "last_received": aggregator.newest or previous,
+                    })
+                else:
+                    clear_sync_state()
+                    log_message("⚠️ Sync was incomplete; the next run will do a full sync", callback_fn)
             except Exception as e:
-                log_message(f"❌ Error processing batch: {str(e)}", callback_fn)
-
-    if not should_stop():
-        # Only process results if not stopped
-        try:
-            aggregated_data = aggregate_email_data(email_data)
-            push_to_airtable(aggregated_data, callback_fn)
-        except Exception as e:
-            log_message(f"❌ Error in final processing: {str(e)}: {format_exc()}", callback_fn)
+                clear_sync_state()
+                log_message(f"❌ Error in final processing: {str(e)}: {format_exc()}", callback_fn)
+    finally:
+        aggregator.close()
 
 if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
     main()